@@ -5,59 +5,283 @@ RADIOLOGY REPORTING ASSISTANT - GUARANTEED WORKING
 import os
 import sys
 import streamlit as st
-import openai
-from dotenv import load_dotenv
-from docx import Document
 from io import BytesIO
 import datetime
 import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
 
 # ===== CRITICAL: LOAD ENV AND INIT AI OUTSIDE STREAMLIT =====
-print("\n" + "="*70, file=sys.stderr)
-print("🚀 APPLICATION STARTUP LOG", file=sys.stderr)
-print("="*70, file=sys.stderr)
+# 1. Force load .env file (once per process, not on every rerun)
+@st.cache_resource(show_spinner=False)
+def load_api_key():
+    print("\n" + "="*70, file=sys.stderr)
+    print("🚀 APPLICATION STARTUP LOG", file=sys.stderr)
+    print("="*70, file=sys.stderr)
+    
+    from dotenv import load_dotenv
+    load_dotenv()
+    api_key = os.getenv("PERPLEXITY_API_KEY")
+    
+    if api_key:
+        print(f"✅ API Key loaded: {api_key[:20]}...", file=sys.stderr)
+    else:
+        print("❌ API Key NOT loaded from .env", file=sys.stderr)
+        # Emergency fallback - read directly
+        try:
+            with open('.env', 'r') as f:
+                for line in f:
+                    if 'PERPLEXITY_API_KEY' in line and '=' in line:
+                        api_key = line.split('=', 1)[1].strip()
+                        print(f"⚠️  API Key loaded directly from file: {api_key[:20]}...", file=sys.stderr)
+                        break
+        except OSError:
+            pass
+    return api_key
 
-# 1. Force load .env file
-load_dotenv()
-API_KEY = os.getenv("PERPLEXITY_API_KEY")
-
-if API_KEY:
-    print(f"✅ API Key loaded: {API_KEY[:20]}...", file=sys.stderr)
-else:
-    print("❌ API Key NOT loaded from .env", file=sys.stderr)
-    # Emergency fallback - read directly
-    try:
-        with open('.env', 'r') as f:
-            for line in f:
-                if 'PERPLEXITY_API_KEY' in line:
-                    API_KEY = line.split('=', 1)[1].strip()
-                    print(f"⚠️  API Key loaded directly from file: {API_KEY[:20]}...", file=sys.stderr)
-                    break
-    except:
-        pass
+API_KEY = load_api_key()
 
 # 2. Initialize Perplexity AI client
+@st.cache_resource(show_spinner=False)
+def get_client(api_key):
+    # One client (and its HTTP connection pool) per process and key;
+    # a failed test raises, so it is retried on the next rerun
+    import openai
+    
+    client = openai.OpenAI(
+        api_key=api_key,
+        base_url="https://api.perplexity.ai"
+    )
+    # Quick silent test
+    client.chat.completions.create(
+        model="sonar",
+        messages=[{"role": "user", "content": "test"}],
+        max_tokens=1
+    )
+    return client
+
+@st.cache_resource(show_spinner=False)
+def _client_log_state():
+    # Last client outcome written to the log, shared by all sessions
+    return {"outcome": None}, threading.Lock()
+
+def _log_client_status(outcome, error=None):
+    # Logged at startup, then again only when the outcome changes
+    state, lock = _client_log_state()
+    with lock:
+        if state["outcome"] == outcome:
+            return
+        if state["outcome"] is not None:
+            print("\n" + "="*70, file=sys.stderr)
+            print("🔄 AI CLIENT STATUS CHANGED", file=sys.stderr)
+            print("="*70, file=sys.stderr)
+        state["outcome"] = outcome
+        
+        if outcome == "no_key":
+            print("❌ Cannot initialize client: No API key", file=sys.stderr)
+        elif outcome == "failed":
+            print(f"❌ Failed to initialize AI client: {error}", file=sys.stderr)
+        else:
+            print("✅ Perplexity AI client initialized successfully", file=sys.stderr)
+        
+        print("="*70 + "\n", file=sys.stderr)
+
 CLIENT = None
 if API_KEY:
     try:
-        CLIENT = openai.OpenAI(
-            api_key=API_KEY,
-            base_url="https://api.perplexity.ai"
-        )
-        # Quick silent test
-        CLIENT.chat.completions.create(
-            model="sonar",
-            messages=[{"role": "user", "content": "test"}],
-            max_tokens=1
-        )
-        print("✅ Perplexity AI client initialized successfully", file=sys.stderr)
+        CLIENT = get_client(API_KEY)
+        _log_client_status("ok")
     except Exception as e:
-        print(f"❌ Failed to initialize AI client: {e}", file=sys.stderr)
+        _log_client_status("failed", e)
         CLIENT = None
 else:
-    print("❌ Cannot initialize client: No API key", file=sys.stderr)
+    _log_client_status("no_key")
+
+# ===== PROMPTS =====
+# Kept free of user input so every request shares a byte-identical prefix
+# that the provider can reuse across calls
+SYSTEM_PROMPT = "You are an expert radiologist."
+
+REPORT_INSTRUCTIONS = """You are a senior radiologist. Create a structured report.
+
+Please provide a complete report with:
+1. TECHNIQUE section
+2. DETAILED FINDINGS section
+3. IMPRESSION section (numbered conclusions)
+
+Use professional medical terminology."""
+
+# ===== AI RESPONSE CACHE =====
+RESPONSE_CACHE_TTL = 86400
+RESPONSE_CACHE_MAX_ENTRIES = 256
+
+@st.cache_resource(show_spinner=False)
+def _response_cache():
+    # Shared by all sessions: request key -> (timestamp, response text).
+    # Sessions run on separate threads, so every access holds the lock
+    return OrderedDict(), threading.Lock()
+
+def _request_key(prompt, system, model, max_tokens):
+    return hashlib.sha256(f"{model}|{max_tokens}|{system}|{prompt}".encode()).hexdigest()
+
+def _stream_completion(prompt, system, model, max_tokens):
+    stream = CLIENT.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=max_tokens,
+        stream=True
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def generate_completion(prompt, system, model, max_tokens):
+    # Identical requests are answered from the cache; new ones are streamed
+    # into the page token by token and cached once complete
+    cache, lock = _response_cache()
+    key = _request_key(prompt, system, model, max_tokens)
+    with lock:
+        hit = cache.get(key)
+    if hit and time.time() - hit[0] < RESPONSE_CACHE_TTL:
+        return hit[1]
+    
+    # The lock is not held while streaming, only while the dict is touched
+    text = st.write_stream(_stream_completion(prompt, system, model, max_tokens))
+    if not text:
+        # Left out of the cache, so pressing Generate again retries
+        raise RuntimeError("The AI returned an empty report")
+    with lock:
+        cache[key] = (time.time(), text)
+        cache.move_to_end(key)
+        # The oldest entries are at the front
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+    return text
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _ping():
+    # Repeated Test Connection clicks within a minute reuse the last answer
+    response = CLIENT.chat.completions.create(
+        model="sonar",
+        messages=[{"role": "user", "content": "Say 'Connected'"}],
+        max_tokens=10
+    )
+    return response.choices[0].message.content
+
+# ===== WORD EXPORT =====
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_docx(report, modality, contrast):
+    # Serialized once per unique report instead of on every rerun;
+    # python-docx is only imported once a document is actually requested
+    from docx import Document
+    
+    doc = Document()
+    doc.add_heading('RADIOLOGY REPORT', 0)
+    doc.add_paragraph(f"Modality: {modality}")
+    doc.add_paragraph(f"Contrast: {contrast}")
+    doc.add_paragraph()
+    
+    # Build <w:p> elements directly, skipping the Paragraph wrapper
+    body = doc.element.body
+    for line in report.split('\n'):
+        line = line.strip()
+        if line:
+            body.add_p().add_r().text = line
+    
+    buffer = BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+# ===== USERS =====
+@st.cache_resource(show_spinner=False)
+def _default_users():
+    # Demo accounts are hashed once per process, not once per session
+    return {
+        "admin": {"password": hashlib.sha256(b"admin123").hexdigest()},
+        "radiologist": {"password": hashlib.sha256(b"rad123").hexdigest()}
+    }
+
+# ===== CALLBACKS =====
+# Run before the next script pass, so no extra st.rerun() is needed
+def _logout():
+    st.session_state.logged_in = False
+
+def _clear_report():
+    del st.session_state.generated_report
+    st.session_state.pop("report_timestamp", None)
 
-print("="*70 + "\n", file=sys.stderr)
+# ===== STATUS PANEL =====
+@st.fragment
+def _status_panel():
+    # Test Connection reruns only this panel
+    
+    # Read-only status lines go out as a single markdown element
+    status_lines = [f"**API Key loaded:** {'✅ Yes' if API_KEY else '❌ No'}"]
+    if API_KEY:
+        status_lines.append(f"**Key starts with:** {API_KEY[:20]}...")
+    status_lines.append(f"**AI Client:** {'✅ Initialized' if CLIENT else '❌ Failed'}")
+    st.markdown("  \n".join(status_lines))
+    
+    if st.button("Test Connection"):
+        if CLIENT:
+            with st.spinner("Testing..."):
+                try:
+                    st.success(f"✅ Connection test passed: {_ping()}")
+                except Exception as e:
+                    st.error(f"❌ Connection failed: {str(e)}")
+        else:
+            st.error("AI client not available")
+
+# ===== REPORT PANE =====
+@st.fragment
+def _report_pane(modality, contrast):
+    # Interactions in here rerun only this pane, not the whole page
+    st.header("📋 Generated Report")
+    
+    if 'generated_report' in st.session_state:
+        # Display report
+        st.text_area(
+            "Report:",
+            st.session_state.generated_report,
+            height=350,
+            key="report_display"
+        )
+        
+        # Download as Word - the document is only built when the button
+        # is clicked, on Streamlit's download thread. A build error shows
+        # as a failed download, with the traceback in the terminal logs
+        report = st.session_state.generated_report
+        st.download_button(
+            label="📄 Download Word Document",
+            data=lambda: build_docx(report, modality, contrast),
+            file_name=f"RadReport_{st.session_state.report_timestamp}.docx",
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            on_click="ignore",
+            use_container_width=True
+        )
+        
+        st.button("🧹 Clear Report", on_click=_clear_report, use_container_width=True)
+    
+    else:
+        st.info("""
+        **No report yet.**
+        
+        To generate a report:
+        1. Select modality and contrast
+        2. Enter findings in the text area
+        3. Click "Generate AI Report"
+        
+        **Try this example:**
+        ```
+        Right basal ganglia hemorrhage measuring 3.2 x 2.1 cm
+        with surrounding edema and 8 mm midline shift.
+        ```
+        """)
 
 # ===== STREAMLIT APP =====
 def main():
@@ -77,10 +301,8 @@ def main():
     
     # Login system
     if 'users' not in st.session_state:
-        st.session_state.users = {
-            "admin": {"password": hashlib.sha256("admin123".encode()).hexdigest()},
-            "radiologist": {"password": hashlib.sha256("rad123".encode()).hexdigest()}
-        }
+        # Copy each account too, so edits never reach the shared cached table
+        st.session_state.users = {u: dict(v) for u, v in _default_users().items()}
         st.session_state.logged_in = False
     
     # Login page
@@ -89,14 +311,14 @@ def main():
         
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
-            with st.container(border=True):
+            with st.form("login_form"):
                 username = st.text_input("Username")
                 password = st.text_input("Password", type="password")
                 
-                if st.button("Login", type="primary", use_container_width=True):
+                if st.form_submit_button("Login", type="primary", use_container_width=True):
                     hashed_pw = hashlib.sha256(password.encode()).hexdigest()
                     if username in st.session_state.users:
-                        if st.session_state.users[username]["password"] == hashed_pw:
+                        if hmac.compare_digest(st.session_state.users[username]["password"], hashed_pw):
                             st.session_state.logged_in = True
                             st.session_state.current_user = username
                             st.success(f"Welcome, {username}!")
@@ -113,31 +335,11 @@ def main():
     # Main app (after login)
     st.write(f"**User:** {st.session_state.current_user}")
     
-    if st.button("🚪 Logout"):
-        st.session_state.logged_in = False
-        st.rerun()
+    st.button("🚪 Logout", on_click=_logout)
     
     # Debug panel
     with st.expander("🔧 System Status", expanded=True):
-        st.write(f"**API Key loaded:** {'✅ Yes' if API_KEY else '❌ No'}")
-        if API_KEY:
-            st.write(f"**Key starts with:** {API_KEY[:20]}...")
-        st.write(f"**AI Client:** {'✅ Initialized' if CLIENT else '❌ Failed'}")
-        
-        if st.button("Test Connection"):
-            if CLIENT:
-                with st.spinner("Testing..."):
-                    try:
-                        response = CLIENT.chat.completions.create(
-                            model="sonar",
-                            messages=[{"role": "user", "content": "Say 'Connected'"}],
-                            max_tokens=10
-                        )
-                        st.success(f"✅ Connection test passed: {response.choices[0].message.content}")
-                    except Exception as e:
-                        st.error(f"❌ Connection failed: {str(e)}")
-            else:
-                st.error("AI client not available")
+        _status_panel()
     
     # Main interface
     col1, col2 = st.columns([1, 1])
@@ -145,112 +347,54 @@ def main():
     with col1:
         st.header("✍️ Input")
         
-        modality = st.selectbox("Modality", ["MRI", "CT", "X-ray", "Ultrasound", "PET-CT"])
-        contrast = st.selectbox("Contrast", ["Without contrast", "With contrast"])
-        
-        findings = st.text_area(
-            "Findings:",
-            height=200,
-            placeholder="Example: Right MCA territory infarct with mass effect and midline shift..."
-        )
+        # Technique and findings are submitted together, costing one rerun
+        with st.form("report_form", border=False):
+            modality = st.selectbox("Modality", ["MRI", "CT", "X-ray", "Ultrasound", "PET-CT"])
+            contrast = st.selectbox("Contrast", ["Without contrast", "With contrast"])
+            
+            findings = st.text_area(
+                "Findings:",
+                height=200,
+                placeholder="Example: Right MCA territory infarct with mass effect and midline shift..."
+            )
+            
+            submitted = st.form_submit_button(
+                "🤖 Generate AI Report",
+                type="primary",
+                use_container_width=True,
+                disabled=not CLIENT
+            )
         
-        if CLIENT and st.button("🤖 Generate AI Report", type="primary", use_container_width=True):
+        if submitted:
             if findings.strip():
-                with st.spinner("AI is generating report..."):
-                    try:
-                        prompt = f"""You are a senior radiologist. Create a structured report.
-
-TECHNIQUE: {modality}, {contrast}
-
-FINDINGS PROVIDED: {findings}
-
-Please provide a complete report with:
-1. TECHNIQUE section
-2. DETAILED FINDINGS section
-3. IMPRESSION section (numbered conclusions)
-
-Use professional medical terminology."""
-                        
-                        response = CLIENT.chat.completions.create(
-                            model="sonar",
-                            messages=[
-                                {"role": "system", "content": "You are an expert radiologist."},
-                                {"role": "user", "content": prompt}
-                            ],
-                            max_tokens=1500
-                        )
-                        
-                        report = response.choices[0].message.content
-                        st.session_state.generated_report = report
-                        st.success("✅ Report generated successfully!")
-                        st.rerun()
-                        
-                    except Exception as e:
-                        st.error(f"AI Error: {str(e)}")
+                try:
+                    # Dynamic input goes after the static prefix
+                    prompt = (
+                        f"{REPORT_INSTRUCTIONS}\n\n"
+                        f"TECHNIQUE: {modality}, {contrast}\n\n"
+                        f"FINDINGS PROVIDED: {findings}"
+                    )
+                    
+                    report = generate_completion(
+                        prompt,
+                        SYSTEM_PROMPT,
+                        "sonar",
+                        1500
+                    )
+                    st.session_state.generated_report = report
+                    st.session_state.report_timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
+                    st.success("✅ Report generated successfully!")
+                    st.rerun()
+                    
+                except Exception as e:
+                    st.error(f"AI Error: {str(e)}")
             else:
                 st.warning("Please enter findings first")
         elif not CLIENT:
             st.warning("AI not available")
     
     with col2:
-        st.header("📋 Generated Report")
-        
-        if 'generated_report' in st.session_state:
-            # Display report
-            st.text_area(
-                "Report:",
-                st.session_state.generated_report,
-                height=350,
-                key="report_display"
-            )
-            
-            # Download as Word
-            try:
-                doc = Document()
-                doc.add_heading('RADIOLOGY REPORT', 0)
-                doc.add_paragraph(f"Modality: {modality}")
-                doc.add_paragraph(f"Contrast: {contrast}")
-                doc.add_paragraph()
-                
-                for line in st.session_state.generated_report.split('\n'):
-                    if line.strip():
-                        doc.add_paragraph(line.strip())
-                
-                buffer = BytesIO()
-                doc.save(buffer)
-                buffer.seek(0)
-                
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
-                st.download_button(
-                    label="📄 Download Word Document",
-                    data=buffer,
-                    file_name=f"RadReport_{timestamp}.docx",
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    use_container_width=True
-                )
-                
-            except Exception as e:
-                st.error(f"Document error: {e}")
-            
-            if st.button("🧹 Clear Report", use_container_width=True):
-                del st.session_state.generated_report
-                st.rerun()
-        
-        else:
-            st.info("""
-            **No report yet.**
-            
-            To generate a report:
-            1. Select modality and contrast
-            2. Enter findings in the text area
-            3. Click "Generate AI Report"
-            
-            **Try this example:**
-            ```
-            Right basal ganglia hemorrhage measuring 3.2 x 2.1 cm
-            with surrounding edema and 8 mm midline shift.
-            ```
-            """)
+        _report_pane(modality, contrast)
 
 if __name__ == "__main__":
     main()